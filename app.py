@@ -1,16 +1,41 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+import functools
+import itertools
 import logging
 import os
+import random
+import threading
 import time
+from typing import Optional
 import requests
+from requests.adapters import HTTPAdapter
 import spotipy
+from urllib3.util.retry import Retry
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+SPOTIFY_TRACKS_PAGE_SIZE = 100
+SPOTIFY_PLAYLISTS_PAGE_SIZE = 50
+SPOTIFY_POOL_SIZE = 16
+SPOTIFY_PREFETCH_PLAYLISTS = 2
+SPOTIFY_MAX_RETRIES = 5
+SPOTIFY_RETRY_STATUSES = (429, 500, 502, 503, 504)
+SPOTIFY_RETRY_AFTER_CAP = 120
+LOGIN_BACKOFF_BASE = 10
+LOGIN_BACKOFF_CAP = 300
+TRACK_FIELDS = "items(track(name,id,external_urls(spotify)))"
+ALBUM_FIELDS = "items(track(name,id,external_urls(spotify),album(name,id,external_urls(spotify))))"
+
 s = requests.Session()
-logging.basicConfig(level=logging.INFO)
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Environment:
     config_path: str
     mode: str
@@ -22,6 +47,47 @@ class Environment:
     spotify_client_secret: str
     spotify_usernames: str
     interval: int
+    log_level: str
+    cache_ttl: int
+    spotify_rate_limit: int
+    deemix_rate_limit: int
+
+
+class RateLimiter:
+    """Token bucket allowing bursts of half a minute's worth of requests by
+    default, matching the 30 second rolling window Spotify enforces."""
+
+    __slots__ = ("capacity", "rate", "tokens", "last_refill", "paused_until", "lock")
+
+    def __init__(self, requests_per_minute: int, capacity: Optional[float] = None):
+        self.capacity = capacity or max(1.0, requests_per_minute / 2)
+        self.rate = requests_per_minute / 60
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds: float) -> None:
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            # Start again from an empty bucket instead of a full burst.
+            self.tokens = 0
+            self.last_refill = self.paused_until
+
+    def wait(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                time.sleep(self.paused_until - now)
+                now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens +
+                              (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self.tokens = 1
+                self.last_refill = time.monotonic()
+            self.tokens -= 1
 
 
 # Read ENV variables
@@ -36,10 +102,50 @@ env = Environment(
     spotify_client_secret=os.getenv("SPOTIFY_CLIENT_SECRET", ""),
     spotify_usernames=os.getenv("SPOTIFY_USERNAMES", ""),
     interval=int(os.getenv("INTERVAL", "")),
+    log_level=os.getenv("LOG_LEVEL", "INFO"),
+    cache_ttl=int(os.getenv("CACHE_TTL", "0")),
+    spotify_rate_limit=int(os.getenv("SPOTIFY_RATE_LIMIT", "180")),
+    deemix_rate_limit=int(os.getenv("DEEMIX_RATE_LIMIT", "60")),
 )
 
+if env.spotify_rate_limit < 1:
+    raise ValueError("SPOTIFY_RATE_LIMIT must be at least 1 request per minute")
+if env.deemix_rate_limit < 1:
+    raise ValueError("DEEMIX_RATE_LIMIT must be at least 1 item per minute")
+
+playlists_cache = f"{env.config_path}/cache/playlists"
+tracks_cache = f"{env.config_path}/cache/tracks"
+albums_cache = f"{env.config_path}/cache/albums"
+track_path_tmpl = tracks_cache + "/%s.json"
+album_path_tmpl = albums_cache + "/%s.json"
+# Outside cache/, which is safe to wipe, since this holds a credential.
+arl_path = f"{env.config_path}/arl.json"
+legacy_arl_path = f"{env.config_path}/cache/arl.json"
+
+spotify_limiter = RateLimiter(env.spotify_rate_limit)
+deemix_limiter = RateLimiter(env.deemix_rate_limit, capacity=1)
+
+
+def login_arl(arl: str) -> bool:
+    response = s.post(f"{env.deemix_url}/api/loginArl", json={"arl": arl})
+    return response.json()["status"] == 1
+
+
+def login_cached_arl() -> bool:
+    try:
+        data = read_json(arl_path)
+        if data.get("email") != env.deezer_email or data.get("deezer_arl") != env.deezer_arl:
+            return False
+        success = login_arl(data["arl"])
+    except Exception:
+        return False
+    logging.info("loging user %s with cached arl: %s", env.deezer_email, success)
+    return success
+
 
 def login():
+    if login_cached_arl():
+        return True
     try:
         response = s.post(
             f"{env.deemix_url}/api/loginEmail",
@@ -53,142 +159,325 @@ def login():
             arl = response.json()["arl"]
         else:
             arl = env.deezer_arl
-        response = s.post(f"{env.deemix_url}/api/loginArl", json={"arl": arl})
-        logging.info(
-            f"loging user {env.deezer_email}: {response.json()['status']==1}")
-        return response.json()["status"] == 1
+        success = login_arl(arl)
+        logging.info("loging user %s: %s", env.deezer_email, success)
+        if success:
+            os.makedirs(os.path.dirname(arl_path), exist_ok=True)
+            write_json(arl_path, {
+                "email": env.deezer_email,
+                "deezer_arl": env.deezer_arl,
+                "arl": arl,
+            }, mode=0o600)
+            if os.path.exists(legacy_arl_path):
+                os.remove(legacy_arl_path)
+        return success
     except Exception as e:
         logging.error(e)
         return False
 
 
 def enqueue(url: str) -> bool:
+    deemix_limiter.wait()
+    try:
+        response = s.post(
+            f"{env.deemix_url}/api/addToQueue",
+            json={
+                "bitrate": "null",
+                "url": url,
+            },
+        )
+        response.raise_for_status()
+        data = response.json()
+    except (requests.RequestException, ValueError) as e:
+        logging.error("could not queue %s: %s", url, e)
+        return False
+    if data.get("result") is False:
+        logging.error("could not queue %s: %s", url, data.get("errid"))
+        return False
+    return True
 
-    response = s.post(
-        f"{env.deemix_url}/api/addToQueue",
-        json={
-            "bitrate": "null",
-            "url": url,
-        },
-    )
 
-    return True
+def read_json(path: str):
+    if orjson is None:
+        with open(path, "r") as f:
+            return json.load(f)
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
 
 
-def download() -> None:
+def write_json(path: str, data, mode: int = 0o666) -> None:
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        if orjson is None:
+            with open(fd, "w") as f:
+                json.dump(data, f)
+        else:
+            with open(fd, "wb") as f:
+                f.write(orjson.dumps(data))
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def load_snapshot(playlist_path: str, snapshot_id: str) -> bool:
+    try:
+        st = os.stat(playlist_path)
+    except OSError:
+        return False
+    if env.cache_ttl > 0 and time.time() - st.st_mtime > env.cache_ttl:
+        return False
+    try:
+        data = read_json(playlist_path)
+    except ValueError:
+        return False
+    return data.get("snapshot_id") == snapshot_id
+
+
+def cached_ids(directory: str) -> set:
+    return {entry.name[:-5] for entry in os.scandir(directory) if entry.name.endswith(".json")}
+
+
+def extract_tracks(items: list):
+    for item in items:
+        track_info = item.get("track")
+        if not track_info:
+            continue
+        if track_info["external_urls"].get("spotify") is None:
+            logging.error(
+                "skipping track %s: missing Spotify link", track_info["name"])
+            continue
+        yield item
+
+
+def retry_after(headers, default: float) -> float:
+    try:
+        return max(0, int((headers or {})["Retry-After"]))
+    except (KeyError, TypeError, ValueError):
+        # Missing, or an HTTP date rather than a number of seconds.
+        return default
+
+
+def spotify_call(fn, *args, **kwargs):
+    attempt = 0
+    while True:
+        spotify_limiter.wait()
+        try:
+            return fn(*args, **kwargs)
+        except spotipy.SpotifyException as e:
+            if attempt == SPOTIFY_MAX_RETRIES or e.http_status not in SPOTIFY_RETRY_STATUSES:
+                raise
+            backoff = 2 ** attempt * random.uniform(0.5, 1.5)
+            attempt += 1
+            if e.http_status == 429:
+                wait = min(SPOTIFY_RETRY_AFTER_CAP, retry_after(e.headers, backoff))
+            else:
+                wait = backoff
+            logging.warning(
+                "spotify returned %s, retrying in %d seconds", e.http_status, wait)
+            if e.http_status == 429:
+                # A 429 applies to the whole app, so every worker waits it out
+                # in spotify_limiter.wait() before its next request.
+                spotify_limiter.pause(wait)
+            else:
+                time.sleep(wait)
+
+
+def user_playlists_page(sp: spotipy.Spotify, username: str, offset: int) -> dict:
+    return spotify_call(sp.user_playlists, username,
+                        limit=SPOTIFY_PLAYLISTS_PAGE_SIZE, offset=offset)
+
+
+def user_playlists(sp: spotipy.Spotify, username: str) -> list:
+    page = user_playlists_page(sp, username, 0)
+    playlists = page["items"]
+    if len(page["items"]) < SPOTIFY_PLAYLISTS_PAGE_SIZE:
+        return playlists
+    # Each user already has a listing worker, so the remaining pages are
+    # fetched in order instead of nesting another pool per user.
+    for offset in range(SPOTIFY_PLAYLISTS_PAGE_SIZE, page["total"], SPOTIFY_PLAYLISTS_PAGE_SIZE):
+        page = user_playlists_page(sp, username, offset)
+        playlists.extend(page["items"])
+        if len(page["items"]) < SPOTIFY_PLAYLISTS_PAGE_SIZE:
+            break
+    return playlists
+
+
+@functools.lru_cache(maxsize=None)
+def spotify() -> spotipy.Spotify:
+    session = requests.Session()
+    # Only connection errors are retried here. Error statuses reach
+    # spotify_call with their headers, so every attempt takes a limiter
+    # token and 429s are paced by Retry-After.
+    retry = Retry(
+        total=3,
+        read=False,
+        allowed_methods=frozenset(["GET", "POST"]),
+        backoff_factor=0.3,
+        respect_retry_after_header=False,
+    )
+    # The listing pool (one worker per user, at most SPOTIFY_POOL_SIZE) can
+    # still be draining while the page pool fetches tracks, so both share
+    # these connections.
+    session.mount("https://", HTTPAdapter(
+        pool_connections=SPOTIFY_POOL_SIZE, pool_maxsize=2 * SPOTIFY_POOL_SIZE,
+        max_retries=retry))
     ccm = spotipy.SpotifyClientCredentials(
-        env.spotify_client_id, env.spotify_client_secret
+        env.spotify_client_id, env.spotify_client_secret, requests_session=session
     )
-    sp = spotipy.Spotify(client_credentials_manager=ccm)
+    return spotipy.Spotify(client_credentials_manager=ccm, requests_session=session)
+
+
+def playlist_tracks_page(sp: spotipy.Spotify, playlist_id: str, offset: int) -> list:
+    playlist_tracks = spotify_call(
+        sp.playlist_tracks,
+        playlist_id,
+        fields=TRACK_FIELDS if env.mode == "tracks" else ALBUM_FIELDS,
+        limit=SPOTIFY_TRACKS_PAGE_SIZE,
+        offset=offset,
+    )
+    return playlist_tracks["items"]
+
+
+def playlist_pages(executor: ThreadPoolExecutor, sp: spotipy.Spotify, playlist: dict):
+    offsets = range(0, playlist["tracks"]["total"], SPOTIFY_TRACKS_PAGE_SIZE)
+    return executor.map(functools.partial(playlist_tracks_page, sp, playlist["id"]), offsets)
+
+
+def iter_playlist_tracks(pages):
+    for items in pages:
+        yield from extract_tracks(items)
+        if len(items) < SPOTIFY_TRACKS_PAGE_SIZE:
+            break
+
+
+def changed_playlists(playlists: list) -> list:
+    changed = []
+    for playlist in playlists:
+        playlist_name = playlist["name"]
+        snapshot_id = playlist["snapshot_id"]
+        owner_cache = f"{playlists_cache}/{playlist['owner']['id']}"
+        playlist_path = f"{owner_cache}/{playlist['id']}.json"
+        cached = load_snapshot(playlist_path, snapshot_id)
+        legacy_path = f"{owner_cache}/{playlist_name}.json"
+        if not cached and load_snapshot(legacy_path, snapshot_id):
+            os.replace(legacy_path, playlist_path)
+            cached = True
+        if cached:
+            logging.info(
+                "skipping %s: already downloaded and no changes detected", playlist_name)
+            continue
+        os.makedirs(owner_cache, exist_ok=True)
+        changed.append((playlist, playlist_path))
+    return changed
+
+
+def queue_tracks(pages, playlist_name: str,
+                 downloaded_tracks: set, downloaded_albums: set) -> bool:
+    complete = True
+    for track in iter_playlist_tracks(pages):
+        track_info = track["track"]
+
+        if env.mode == "tracks":
+            track_id = track_info["id"]
+            if track_id in downloaded_tracks:
+                logging.info(
+                    "skipping %s: already downloaded", track_info["name"])
+                continue
+            logging.info(
+                "queuing %s from %s", track_info["name"], playlist_name)
+            success = enqueue(track_info["external_urls"]["spotify"])
+            if success:
+                write_json(track_path_tmpl % track_id, track)
+                downloaded_tracks.add(track_id)
+            complete = complete and success
+        else:
+            album = track_info["album"]
+            album_id = album["id"]
+            if album_id in downloaded_albums:
+                logging.info(
+                    "skipping %s: already downloaded", album["name"])
+                continue
+            logging.info(
+                "queuing %s from %s", album["name"], playlist_name)
+            success = enqueue(album["external_urls"]["spotify"])
+            if success:
+                write_json(album_path_tmpl % album_id, album)
+                write_json(track_path_tmpl % track_info["id"], track)
+                downloaded_albums.add(album_id)
+                downloaded_tracks.add(track_info["id"])
+            complete = complete and success
+    return complete
+
+
+def download() -> None:
+    sp = spotify()
+    os.makedirs(tracks_cache, exist_ok=True)
+    os.makedirs(albums_cache, exist_ok=True)
+    downloaded_tracks = cached_ids(tracks_cache)
+    downloaded_albums = cached_ids(albums_cache)
     usernames = env.spotify_usernames.split(",")
-    for username in usernames:
-        user_playlists = sp.user_playlists(username)
-        for playlist in user_playlists["items"]:
-            playlist_name = playlist["name"]
-            playlist_link = playlist["external_urls"]["spotify"]
-            owner = playlist["owner"]["id"]
-            snapshot_id = playlist["snapshot_id"]
-            number_of_tracks = playlist["tracks"]["total"]
-
-            if not os.path.exists(f"{env.config_path}/cache/playlists/{owner}"):
-                os.makedirs(f"{env.config_path}/cache/playlists/{owner}")
-
-            playlist_path = f"{env.config_path}/cache/playlists/{owner}/{playlist_name}.json"
-            if os.path.exists(playlist_path):
-                with open(playlist_path, "r") as f:
-                    data = json.load(f)
-                    if data["snapshot_id"] == snapshot_id:
-                        logging.info(
-                            f"skipping {playlist_name}: already downloaded and no changes detected")
-                        continue
-
-            if env.mode == "playlists":
-                logging.info(f"queuing {playlist_name}")
-                enqueue(playlist_link)
-                time.sleep(1)
-            else:
-                k = number_of_tracks // 100
-                r = 1 if number_of_tracks > k * 100 else 0
-
-                for i in range(k + r):
-
-                    playlist_tracks = sp.playlist_tracks(
-                        playlist_link, limit=100, offset=i)
-                    for track in playlist_tracks["items"]:
-                        track_name = track["track"]["name"]
-                        if track["track"]["external_urls"].get("spotify") is None:
-                            logging.error(
-                                f"skipping track {track_name}: missing Spotify link")
-                            continue
-                        track_link = track["track"]["external_urls"]["spotify"]
-                        track_id = track["track"]["id"]
-                        track_path = f"{env.config_path}/cache/tracks/{track_id}.json"
-
-                        if not os.path.exists(f"{env.config_path}/cache/tracks"):
-                            os.makedirs(f"{env.config_path}/cache/tracks")
-                        if not os.path.exists(f"{env.config_path}/cache/albums"):
-                            os.makedirs(f"{env.config_path}/cache/albums")
-
-                        if env.mode == "tracks":
-
-                            if os.path.exists(track_path):
-                                with open(track_path) as f:
-                                    data = json.load(f)
-                                    if data["track"]["id"] == track_id:
-                                        logging.info(
-                                            f"skipping {track_name}: already downloaded")
-                                        continue
-                            logging.info(
-                                f"queuing {track_name} from {playlist_name} offset {i}")
-                            success = enqueue(track_link)
-                            if success:
-                                with open(track_path, "w") as f:
-                                    json.dump(track, f)
-                            time.sleep(1)
-                        else:
-                            album = track["track"]["album"]
-                            album_name = album["name"]
-                            album_link = album["external_urls"]["spotify"]
-                            album_id = album["id"]
-                            album_path = f"{env.config_path}/cache/albums/{album_id}.json"
-                            if os.path.exists(album_path):
-                                with open(album_path) as f:
-                                    data = json.load(f)
-                                    if data["id"] == album_id:
-                                        logging.info(
-                                            f"skipping {album_name}: already downloaded")
-                                        continue
-                            logging.info(
-                                f"queuing {album_name} from {playlist_name} offset {i}")
-                            album = sp.album(album_link)
-                            success = enqueue(album_link)
-                            if success:
-                                with open(album_path, "w") as f:
-                                    json.dump(album, f)
-                                with open(track_path, "w") as f:
-                                    json.dump(track, f)
-
-                            time.sleep(1)
-
-            with open(playlist_path, "w") as f:
-                json.dump(playlist, f)
+    executor = ThreadPoolExecutor(max_workers=min(SPOTIFY_POOL_SIZE, len(usernames)))
+    all_playlists = executor.map(
+        functools.partial(user_playlists, sp), usernames)
+    executor.shutdown(wait=False)
+    for playlists in all_playlists:
+        changed = changed_playlists(playlists)
+        if env.mode == "playlists":
+            for playlist, playlist_path in changed:
+                logging.info("queuing %s", playlist["name"])
+                if enqueue(playlist["external_urls"]["spotify"]):
+                    write_json(playlist_path, playlist)
+            continue
+
+        pages_executor = ThreadPoolExecutor(max_workers=SPOTIFY_POOL_SIZE)
+        prefetched = collections.deque()
+        upcoming = iter(changed)
+        try:
+            for playlist, playlist_path in changed:
+                # Only the next few playlists have their pages in flight, so
+                # a user with many changed playlists does not queue them all.
+                for next_playlist, _ in itertools.islice(
+                        upcoming, SPOTIFY_PREFETCH_PLAYLISTS - len(prefetched)):
+                    prefetched.append(playlist_pages(pages_executor, sp, next_playlist))
+                pages = prefetched.popleft()
+                try:
+                    complete = queue_tracks(
+                        pages, playlist["name"], downloaded_tracks, downloaded_albums)
+                except spotipy.SpotifyException as e:
+                    logging.error("could not fetch %s: %s", playlist["name"], e)
+                    continue
+                finally:
+                    # Cancels the pages left after a short page or an error.
+                    pages.close()
+                if complete:
+                    write_json(playlist_path, playlist)
+        finally:
+            pages_executor.shutdown(wait=False, cancel_futures=True)
 
 
 def clear_queue():
     response = s.post(f"{env.deemix_url}/api/removeFinishedDownloads")
-    logging.info(f"clearing queue: {response.text}")
+    logging.info("clearing queue: %s", response.text)
 
 
 def main():
+    logging.basicConfig(level=env.log_level.upper())
+
+    attempt = 0
     while not login():
-        wait = 60
-        logging.error(f"could not login, retrying in {wait} seconds")
+        wait = min(LOGIN_BACKOFF_CAP, LOGIN_BACKOFF_BASE * 2 ** attempt)
+        wait *= random.uniform(0.5, 1.5)
+        attempt += 1
+        logging.error("could not login, retrying in %d seconds", wait)
         time.sleep(wait)
 
     while True:
         clear_queue()
         download()
-        logging.info(f"sleeping for {env.interval} seconds")
+        logging.info("sleeping for %d seconds", env.interval)
         time.sleep(env.interval)
 
 